@@ -1,28 +1,37 @@
 import argparse
+import functools
 import logging
 import os
 import re
 import signal
 import sys
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import Enum, unique
 from pathlib import Path
 from time import sleep
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 import praw
 import requests
 import yaml
-from praw import Reddit
 from praw.models import Submission
 
+# Use the libyaml-backed loader when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as YamlSafeLoader
+except ImportError:
+    from yaml import SafeLoader as YamlSafeLoader
+
 
 def __get_logger() -> logging.Logger:
     """Sets basic logging configuration and returns the logger for this module. Reads an env var called WEMB_LOGLEVEL to set the log level"""
-    logging.basicConfig(
-        stream=sys.stdout,
-        format="{asctime} - {name:<12} {levelname:<8}:  {message}",
-        style="{",
-    )
+    # Only configure the root logger if nothing else has already
+    if not logging.getLogger().handlers:
+        logging.basicConfig(
+            stream=sys.stdout,
+            format="{asctime} - {name:<12} {levelname:<8}:  {message}",
+            style="{",
+        )
 
     # Get log level from env var
     log_level = os.environ.get("WEMB_LOGLEVEL") or logging.DEBUG
@@ -33,7 +42,7 @@ def __get_logger() -> logging.Logger:
         logger.setLevel(log_level)
     except ValueError:
         logger.setLevel(logging.DEBUG)
-        logger.warning(f"Invalid WEMB_LOGLEVEL ({log_level})! Defaulting to DEBUG...")
+        logger.warning("Invalid WEMB_LOGLEVEL (%s)! Defaulting to DEBUG...", log_level)
 
     return logger
 
@@ -42,13 +51,20 @@ def __get_logger() -> logging.Logger:
 class SubmissionType(Enum):
     """Represents a type of submission (either WTS or WTB)"""
 
-    def __init__(self, value):
-        # Formats a string such as [wts] or [wtb] for comparison purposes
-        self.formatted_value = f"[{str(value).lower()}]"
-
     WTB = "WTB"
     WTS = "WTS"
 
+    @property
+    def formatted_value(self) -> str:
+        """A string such as [wts] or [wtb] for comparison purposes"""
+        return _SUBMISSION_TYPE_TAGS[self]
+
+
+_SUBMISSION_TYPE_TAGS: Dict[SubmissionType, str] = {
+    SubmissionType.WTB: "[wtb]",
+    SubmissionType.WTS: "[wts]",
+}
+
 
 class SubmissionCriterion:
     """Class that represents some criteria for finding a post on the subreddit. Each instance of this object represents a different query.
@@ -60,17 +76,15 @@ class SubmissionCriterion:
     """
 
     @staticmethod
-    def __process_keywords(initial: Optional[List[str]]) -> List[str]:
-        keywords = list()
-
+    def __process_keywords(initial: Optional[List[str]]) -> Tuple[str, ...]:
         if initial is None or len(initial) == 0:
-            # Append an empty string item so loop logic works
-            keywords.append("")
-        else:
-            for element in initial:
-                keywords.append(element.lower())
+            # Use a single empty string item so matching logic works
+            return ("",)
 
-        return keywords
+        # Longer keywords tend to be more specific, so checking them first lets all_required fail sooner
+        return tuple(
+            sorted((element.lower() for element in initial), key=len, reverse=True)
+        )
 
     def __init__(
         self,
@@ -81,9 +95,19 @@ class SubmissionCriterion:
     ):
         self.submission_type: SubmissionType = SubmissionType(submission_type)
         self.min_transactions: int = min_transactions
-        self.keywords: List[str] = self.__process_keywords(keywords)
+        self.keywords: Tuple[str, ...] = self.__process_keywords(keywords)
         self.all_required: bool = all_required
 
+        # Tag such as "[wts]", looked up once here instead of on every title check
+        self._tag: str = self.submission_type.formatted_value
+
+        # When any keyword is enough, one compiled alternation scans the title in a single pass
+        self._any_keyword: Optional[re.Pattern] = (
+            None
+            if all_required
+            else re.compile("|".join(re.escape(k) for k in self.keywords))
+        )
+
         if min_transactions < 0:
             raise ValueError("min_transactions must be a positive integer!")
 
@@ -95,25 +119,19 @@ class SubmissionCriterion:
         title = title.lower()
 
         # Check if something like "[WTB]" is in the title
-        if self.submission_type.formatted_value not in title:
+        if self._tag not in title:
             return False
 
-        if self.all_required:
-            # Check if ALL the keywords match
-            for k in self.keywords:
-                # Found a keyword that's not in the title, so we return false
-                if k not in title:
-                    return False
-            # None of the keywords caused the loop to exit, which means we found all of them
-            return True
-
-        else:
-            # Check if any of the keywords match
-            for k in self.keywords:
-                if k in title:
-                    return True
+        return self.check_keywords(title)
 
-        return False
+    def check_keywords(self, title_lc: str):
+        """Checks only the keywords against an already lowercased title, skipping the submission type check. For callers that have already matched the type."""
+
+        if self._any_keyword is not None:
+            return self._any_keyword.search(title_lc) is not None
+
+        # ALL the keywords need to match. A regex can't be used here, as it wouldn't find keywords that overlap in the title.
+        return all(k in title_lc for k in self.keywords)
 
 
 class ProgramConfiguration:
@@ -126,7 +144,7 @@ class ProgramConfiguration:
             raise ValueError(f"Config file at {config_path} does not exist!")
 
         with config_path.open() as file:
-            contents = yaml.safe_load(file)
+            contents = yaml.load(file, Loader=YamlSafeLoader)
 
         self.criteria: List[SubmissionCriterion] = list()
 
@@ -141,41 +159,80 @@ class ProgramConfiguration:
                 )
             )
 
-        LOGGER.debug(f"  Loaded {len(self.criteria)} criteria: {self.criteria}")
+        LOGGER.debug("  Loaded %d criteria: %s", len(self.criteria), self.criteria)
+
+        # Group the criteria by submission type, so a title only needs to be checked against the criteria for the tags it contains
+        self.criteria_by_type: Dict[SubmissionType, List[SubmissionCriterion]] = {
+            submission_type: list() for submission_type in SubmissionType
+        }
+        for criterion in self.criteria:
+            self.criteria_by_type[criterion.submission_type].append(criterion)
+
+        # The lowest transaction count any criterion accepts. Authors below this can't match anything.
+        self.min_transactions: int = min(
+            (criterion.min_transactions for criterion in self.criteria), default=0
+        )
 
         self.webhookUrl = contents["callback"]["webhookUrl"]
         self.mentionString = contents["callback"]["mentionString"]
 
+        # Optional. If true, only the first matching criterion sends a message for a submission.
+        self.firstMatchWins: bool = contents.get("firstMatchWins", False)
+
 
-RE_TRANSACTIONS = re.compile(r"^\d+")
 SUBREDDIT_WATCHEXCHANGE = "watchexchange"
 LOGGER = __get_logger()
 
+# Shared HTTP session, so webhook posts reuse the same keep-alive connection to Discord
+HTTP_SESSION = requests.Session()
+# Seconds to wait on Discord before giving up on a webhook post, so a stalled request can't hold up the ones queued behind it
+WEBHOOK_TIMEOUT = 10
+
+# Webhook posts run here, so the stream can keep reading while Discord responds. One worker keeps the messages in order.
+WEBHOOK_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="webhook")
+
+# Set once the first SIGINT/SIGTERM is handled, and once its exit delay is over. Repeated signals are ignored during the delay, and force an exit after it.
+_shutdown_started = False
+_shutdown_delay_over = False
+
+
+def get_permalink(reddit_url: str, submission: Submission):
+    """Gets a permalink to the submission passed in the second argument. reddit_url is the base URL from the Reddit instance's config (reddit.config.reddit_url)"""
+
+    return reddit_url + submission.permalink
+
 
-def get_permalink(reddit: Reddit, submission: Submission):
-    """Gets a permalink to the submission passed in the second argument"""
+def get_leading_int(text: Optional[str]) -> Optional[int]:
+    """Parses the integer at the very start of a string (such as a user's flair, "12 Transactions"). Returns None if the string doesn't start with a digit."""
 
-    return f"{reddit.config.reddit_url + submission.permalink}"
+    if not text:
+        return None
 
+    i = 0
+    n = len(text)
+    while i < n and text[i].isdecimal():
+        i += 1
 
-def check_criteria(criterion: SubmissionCriterion, submission: Submission) -> bool:
-    """Helper function that checks a given criterion object against a submission. Returns true if all gates pass, false otherwise."""
+    return int(text[:i]) if i else None
 
-    # Check the title. If that doesn't match, go to the next item and mark this as processed
-    if not criterion.check_title(submission.title):
+
+def check_criteria(
+    criterion: SubmissionCriterion, title_lc: str, transactions: Optional[int]
+) -> bool:
+    """Helper function that checks a given criterion object against a submission's lowercased title and the transaction count parsed from its author flair (None if the flair is invalid). The title is expected to already contain the criterion's submission type tag. Returns true if all gates pass, false otherwise."""
+
+    # Check the title keywords. If that doesn't match, go to the next item and mark this as processed
+    if not criterion.check_keywords(title_lc):
         LOGGER.debug("    Failed on title criteria (1/2)")
         return False
 
     # Check minimum transactions of the submitting user
-    try:
-        if (
-            int(RE_TRANSACTIONS.match(submission.author_flair_text)[0])
-            < criterion.min_transactions
-        ):
-            LOGGER.debug("    Failed on minimum transaction count (2/2)")
-            return False
-    except TypeError:
-        LOGGER.warning(f"    Submission has INVALID user flair!")
+    if transactions is None:
+        LOGGER.warning("    Submission has INVALID user flair!")
+        return False
+
+    if transactions < criterion.min_transactions:
+        LOGGER.debug("    Failed on minimum transaction count (2/2)")
         return False
 
     # If both gates have been passed, we have matched all criteria
@@ -189,47 +246,143 @@ def process_submissions(reddit: praw.Reddit, args, callback=None):
 
     config = ProgramConfiguration(args.config_file)
 
+    # Bind everything that stays the same between submissions once, skipping types without any criteria
+    criteria_by_tag = [
+        (submission_type.formatted_value, tuple(criteria))
+        for submission_type, criteria in config.criteria_by_type.items()
+        if criteria
+    ]
+    notify = (
+        None
+        if callback is None
+        else functools.partial(
+            callback,
+            webhook_url=config.webhookUrl,
+            mention_string=config.mentionString,
+        )
+    )
+    first_match_wins = config.firstMatchWins
+    reddit_url = reddit.config.reddit_url
+    min_transactions = config.min_transactions
+
     LOGGER.info("Started Stream!")
 
     submission: Submission
     for submission in reddit.subreddit(SUBREDDIT_WATCHEXCHANGE).stream.submissions():
 
+        title = submission.title
+        flair = submission.author_flair_text
+
+        # Built at most once per submission, and only when the debug log or a webhook message needs it
+        permalink: Optional[str] = None
+
         LOGGER.info("")
-        LOGGER.info(f"Incoming submission ({submission.id}):")
-        LOGGER.debug(f"  URL: {get_permalink(reddit, submission)}")
-        LOGGER.debug(f"  Title: {submission.title}")
-        LOGGER.debug(f"  Flair: {submission.author_flair_text}")
+        LOGGER.info("Incoming submission (%s):", submission.id)
+
+        # Arguments are evaluated even when DEBUG is off, so skip building the permalink entirely
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            permalink = get_permalink(reddit_url, submission)
+            LOGGER.debug("  URL: %s", permalink)
+            LOGGER.debug("  Title: %s", title)
+            LOGGER.debug("  Flair: %s", flair)
+
+        # Lowercase the title and parse the flair once, instead of once per criterion
+        title_lc = title.lower()
+        transactions = get_leading_int(flair)
+
+        # Skip every criterion at once if the author can't meet any of their minimums. Invalid flairs still go through, so they get logged.
+        if transactions is not None and transactions < min_transactions:
+            LOGGER.info("  Author has fewer transactions than any criterion requires")
+            continue
 
         # This is a new post, so we have to analyze it with respect to the criteria.
-        for criterion in config.criteria:
+        matched = False
+        for tag, criteria in criteria_by_tag:
 
-            LOGGER.info(f"  Checking {criterion}...")
+            # Skip every criterion of this type at once if the title doesn't contain something like "[wts]"
+            if tag not in title_lc:
+                continue
 
-            if check_criteria(criterion, submission):
-                LOGGER.info("    Matched! Sending message...")
-                callback(reddit, submission, config.webhookUrl, config.mentionString)
-            else:
-                LOGGER.info("    Did not match")
+            for criterion in criteria:
 
+                LOGGER.info("  Checking %s...", criterion)
 
-def post_discord_message(
-    reddit: Reddit, submission: Submission, webhook_url, mention_string
-):
+                if check_criteria(criterion, title_lc, transactions):
+                    LOGGER.info("    Matched! Sending message...")
+                    if notify is not None:
+                        if permalink is None:
+                            permalink = get_permalink(reddit_url, submission)
+                        notify(permalink)
+                    matched = True
+
+                    if first_match_wins:
+                        break
+                else:
+                    LOGGER.info("    Did not match")
+
+            if matched and first_match_wins:
+                break
+
+
+def post_discord_message(permalink: str, webhook_url, mention_string):
     """Posts a message using a webhook, including the submission URL and mentioning a user/role"""
 
-    response = requests.post(
+    response = HTTP_SESSION.post(
         webhook_url,
         json={
-            "content": f"{mention_string} {get_permalink(reddit, submission)}",
+            "content": f"{mention_string} {permalink}",
         },
+        timeout=WEBHOOK_TIMEOUT,
     )
 
-    LOGGER.debug(f"Response: {response}")
+    LOGGER.debug("Response: %s", response)
+
+    # Raise on 4xx/5xx (e.g. rate limited, or a deleted webhook), so it gets logged as a failure
+    response.raise_for_status()
+
+
+def __log_webhook_failure(future: Future):
+    """Logs the exception of a finished webhook post, if it failed"""
+
+    # Posts dropped on shutdown have nothing to report
+    if future.cancelled():
+        return
+
+    exception = future.exception()
+    if exception is not None:
+        LOGGER.error("Failed to send webhook message!", exc_info=exception)
+
+
+def post_discord_message_in_background(permalink: str, webhook_url, mention_string):
+    """Queues post_discord_message on a background thread and returns immediately, so processing the stream doesn't wait on the webhook request"""
+
+    future = WEBHOOK_EXECUTOR.submit(
+        post_discord_message, permalink, webhook_url, mention_string
+    )
+    future.add_done_callback(__log_webhook_failure)
 
 
 def __signal_handler(signum, frame):
+    global _shutdown_started, _shutdown_delay_over
+
+    if _shutdown_started:
+        # Still exiting normally, so there's nothing more to do yet
+        if not _shutdown_delay_over:
+            return
+
+        # The normal exit is stuck (e.g. waiting on a thread), so skip the cleanup and leave right away
+        LOGGER.warning("SIGINT/SIGTERM Captured again! Forcing exit...")
+        os._exit(1)
+
+    _shutdown_started = True
+
     LOGGER.info("SIGINT/SIGTERM Captured! Exiting...")
+
+    # Drop any queued webhook posts, so exiting only waits on the one in flight (at most WEBHOOK_TIMEOUT)
+    WEBHOOK_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+
     sleep(1)
+    _shutdown_delay_over = True
     sys.exit(0)
 
 
@@ -251,7 +404,7 @@ def main():
     signal.signal(signal.SIGINT, __signal_handler)
     signal.signal(signal.SIGTERM, __signal_handler)
 
-    process_submissions(reddit, args, callback=post_discord_message)
+    process_submissions(reddit, args, callback=post_discord_message_in_background)
 
 
 if __name__ == "__main__":